@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 from datetime import datetime
 from geopy.distance import great_circle
 import json
@@ -38,21 +39,13 @@ if SECTION_NAME not in ROAD_SECTIONS:
 ROAD_SECTION = ROAD_SECTIONS[SECTION_NAME]
 
 
-def calc_lat_range(bus_lane):
-    # Extract latitudes from the BUS_LANE list
-    latitudes = [point["latitude"] for point in ROAD_SECTION]
-
-    # Find the minimum and maximum latitudes
-    min_latitude = min(latitudes)
-    max_latitude = max(latitudes)
-
-    # Calculate the desired values
-    lower_bound = min_latitude - 0.000346
-    upper_bound = max_latitude + 0.000346
-
-    return lower_bound, upper_bound
-
-LAT_RANGE = calc_lat_range(ROAD_SECTION)
+# Fixes are polled roughly every POLL_INTERVAL seconds. Section entry/exit times are
+# interpolated between the fixes either side of each boundary; boundaries bridged by a
+# gap longer than MAX_INTERPOLATION_GAP are too uncertain to use.
+POLL_INTERVAL = 30  # seconds
+MAX_INTERPOLATION_GAP = 180  # seconds
+# how far (in degrees) the interpolated boundary crossing may sit from the section line
+LATERAL_TOLERANCE = 0.000346
 
 BUSFILE = f'csv_data/bus_data/buses_{DATE}.csv'
 
@@ -65,69 +58,90 @@ def get_lat_lon(location_json):
   return data["latitude"], data["longitude"]
 
 
-def calculate_distance_and_time(group):
-    group = group.sort_values(timestamp_col)
-    
-    # Find the points just before, within, and just after the ROAD_SECTION range
-    # this assumes traffic travelling westbound (i.e decreasing longitude over time)
-    after_section = group[group['longitude'] < ROAD_SECTION[0]['longitude']].iloc[:1] if not group[group['longitude'] < ROAD_SECTION[0]['longitude']].empty else pd.DataFrame()
-    in_section = group[
-        (group['longitude'].between(ROAD_SECTION[0]['longitude'], ROAD_SECTION[1]['longitude'], inclusive='both')) &
-        (group['latitude'].between(LAT_RANGE[0], LAT_RANGE[1], inclusive='both'))
+def section_progress(latitudes, longitudes):
+    # Project positions onto the section line using a local flat-earth approximation.
+    # this assumes traffic travelling westbound, so the section is entered at ROAD_SECTION[1]
+    # (progress 0) and left at ROAD_SECTION[0] (progress 1).
+    # Also returns the perpendicular offset from the section line, in degrees.
+    entry, exit_point = ROAD_SECTION[1], ROAD_SECTION[0]
+    scale = np.cos(np.radians(entry['latitude']))
+    axis_x = (exit_point['longitude'] - entry['longitude']) * scale
+    axis_y = exit_point['latitude'] - entry['latitude']
+    length = np.hypot(axis_x, axis_y)
+
+    dx = (longitudes - entry['longitude']) * scale
+    dy = latitudes - entry['latitude']
+    progress = (dx * axis_x + dy * axis_y) / length**2
+    offset = (dx * axis_y - dy * axis_x) / length
+    return progress, offset
+
+
+def interpolate_crossings(points, boundary):
+    # points must be sorted by journey then time. A crossing is a pair of consecutive fixes
+    # from the same journey that straddle the boundary; the crossing time and position are
+    # linearly interpolated between them. Returns the first crossing for each journey.
+    following = points.shift(-1)
+    crossed = (
+        (following['journey'] == points['journey']) &
+        (points['progress'] < boundary) &
+        (following['progress'] >= boundary)
+    )
+    before, after = points[crossed], following[crossed]
+
+    fraction = (boundary - before['progress']) / (after['progress'] - before['progress'])
+    crossings = pd.DataFrame({
+        'journey': before['journey'],
+        'time': before['time'] + fraction * (after['time'] - before['time']),
+        'latitude': before['latitude'] + fraction * (after['latitude'] - before['latitude']),
+        'longitude': before['longitude'] + fraction * (after['longitude'] - before['longitude']),
+        'gap': after['time'] - before['time'],
+        'row': before.index,
+    })
+    offset = before['offset'] + fraction * (after['offset'] - before['offset'])
+    return crossings[offset.abs() <= LATERAL_TOLERANCE]
+
+
+def calculate_section_times(data):
+    # Estimate section entry/exit times and implied speed for every journey at once.
+    # Returns one row per journey, positioned at the interpolated section entry.
+    data = data.copy()
+    data['journey'] = data.groupby(journey_ref_col).ngroup()
+    data = data[data['journey'] >= 0]
+    data['time'] = (data[timestamp_col] - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+    data['progress'], data['offset'] = section_progress(data['latitude'].values, data['longitude'].values)
+    points = data.sort_values(['journey', 'time'])[
+        ['journey', 'time', 'latitude', 'longitude', 'progress', 'offset']
     ]
-    before_section = group[group['longitude'] > ROAD_SECTION[1]['longitude']].iloc[-1:] if not group[group['longitude'] > ROAD_SECTION[1]['longitude']].empty else pd.DataFrame()
-    
-    relevant_points = pd.concat([before_section, in_section, after_section]).sort_values(timestamp_col)
-    
-    # check that after sorting by time, the longitude values are decreasing (if not implies an error in the data)
-    if not relevant_points['longitude'].is_monotonic_decreasing:
-        print("Error: Longitude values are not decreasing as expected for this group.")
-        print(relevant_points[['line_ref', 'longitude', timestamp_col]])
-        return group
-    
-    # Initialize new columns with default values
-    group['in_section'] = False
-    group['avg_speed'] = 0
-    group['implied_speed'] = 0
-
-    if len(relevant_points) < 2:
-        return group
-    
-    first_point = relevant_points.iloc[0]
-    last_point = relevant_points.iloc[-1]
-    
-    # Calculate total distance and time
-    total_distance = great_circle(
-        (first_point['latitude'], first_point['longitude']),
-        (last_point['latitude'], last_point['longitude'])
-    ).kilometers
-    
-    total_time = (last_point[timestamp_col] - first_point[timestamp_col]).total_seconds() / 3600  # in hours
-    
-    # Calculate average speed
-    avg_speed = total_distance / total_time if total_time > 0 else 0
-    
-    # Calculate implied speed in section
+
+    entries = interpolate_crossings(points, 0)
+    exits = interpolate_crossings(points, 1)
+
+    # pair each journey's first entry with its first exit after that entry
+    journeys = entries.drop_duplicates('journey').merge(exits, on='journey', suffixes=('_entry', '_exit'))
+    journeys = journeys[journeys['time_exit'] > journeys['time_entry']]
+    journeys = journeys.sort_values(['journey', 'time_exit']).drop_duplicates('journey')
+
+    max_gap = journeys[['gap_entry', 'gap_exit']].max(axis=1)
+    journeys = journeys[max_gap <= MAX_INTERPOLATION_GAP]
+    max_gap = max_gap[max_gap <= MAX_INTERPOLATION_GAP]
+
     section_distance = great_circle(
         (ROAD_SECTION[0]['latitude'], ROAD_SECTION[0]['longitude']),
         (ROAD_SECTION[1]['latitude'], ROAD_SECTION[1]['longitude'])
     ).kilometers
-    
-    # Calculate the fraction of total distance that the section represents
-    if total_distance > 0:
-        time_fraction = section_distance / total_distance
-        implied_time = total_time * time_fraction
-    else:
-        implied_time = 0
-    
-    implied_speed = section_distance / implied_time if implied_time > 0 else 0
-    
-    # Add new columns to the group
-    group['in_section'] = group.index.isin(in_section.index)
-    group['avg_speed'] = avg_speed
-    group['implied_speed'] = implied_speed
-    
-    return group
+    section_time = (journeys['time_exit'] - journeys['time_entry']) / 3600  # in hours
+
+    result = data.loc[journeys['row_entry']].reset_index(drop=True)
+    result['latitude'] = journeys['latitude_entry'].values
+    result['longitude'] = journeys['longitude_entry'].values
+    result[timestamp_col] = pd.to_datetime(journeys['time_entry'].values, unit='s', utc=True)
+    result['exit_time'] = pd.to_datetime(journeys['time_exit'].values, unit='s', utc=True)
+    result['implied_speed'] = (section_distance / section_time).values
+    # 1 when both boundaries are bracketed by fixes a single poll apart, falling as the gaps grow
+    result['confidence'] = (POLL_INTERVAL / max_gap.clip(lower=POLL_INTERVAL)).values
+
+    print(f"Interpolated section times for {len(result)} of {data['journey'].nunique()} journeys")
+    return result
 
 
 # Load the CSV data
@@ -141,7 +155,9 @@ journey_ref_col = [
     "dated_vehicle_journey_ref", "origin_aimed_departure_time", "vehicle_ref", "direction_ref"
     ]
 
-bus_data[timestamp_col] = bus_data[timestamp_col].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S%z'))
+bus_data[timestamp_col] = pd.to_datetime(
+    bus_data[timestamp_col].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S%z')), utc=True
+)
 locations_list = bus_data[location_col].apply(get_lat_lon).tolist()
 bus_data["latitude"], bus_data["longitude"] = zip(*locations_list)
 
@@ -154,18 +170,14 @@ bus_data = bus_data[bus_data['operator_ref'] == 'SDVN']
 # remove R bus (as R inbound goes wrong way and also not down Fore Street)
 bus_data = bus_data[bus_data['line_ref'] != 'R']
 
-# Group by journey_ref and vehicle and calculate distance and time within each group
-grouped_data = bus_data.groupby(journey_ref_col)
-bus_data = grouped_data.apply(calculate_distance_and_time)
-
-# filter to buses only section
-bus_data = bus_data[bus_data['in_section'] == True]
+# Interpolate section entry/exit times for every journey
+bus_data = calculate_section_times(bus_data)
 
 # save the interesting data:
 tosave = bus_data[[
     "direction_ref", "line_ref", "dated_vehicle_journey_ref", 
     "latitude", "longitude", "recorded_at_time",
-    "implied_speed"
+    "implied_speed", "exit_time", "confidence"
 ]]
 
 # Update file paths